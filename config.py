@@ -10,6 +10,8 @@ class Config:
     API_ENDPOINT = "https://fal.run/fal-ai/flux-kontext-lora"
     LORA_URL = "https://huggingface.co/ShadoWxShinigamI/harmonize/resolve/main/harmonize.safetensors"
     LORA_WEIGHT = 1.3
+    STORAGE_UPLOAD_ENDPOINT = "https://rest.alpha.fal.ai/storage/upload/initiate"
+    UPLOAD_IMAGES = True      # True: Upload input to fal storage, False: Send base64 data URI
     
     # Default Processing Parameters
     DEFAULT_PROMPT = "harmonize with consistent colours and lighting and shadows"
@@ -29,31 +31,37 @@ class Config:
     # File Management
     OUTPUT_DIR = "output"
     MAX_BATCH_SIZE = 50       # Maximum number of images in batch processing
+    BATCH_WORKERS = 8         # Concurrent API requests during batch processing
     SUPPORTED_FORMATS = [".jpg", ".jpeg", ".png", ".webp", ".bmp"]
+    METADATA_COMPACT_INTERVAL = 500  # Journal entries before metadata.json is rewritten
     
     # UI Configuration
     GALLERY_COLUMNS = 3
     GALLERY_HEIGHT = "400px"
     MAX_FILE_SIZE = "50MB"
     
+    # Static part of every API payload, built once at class load
+    _BASE_PAYLOAD = {
+        "num_inference_steps": NUM_INFERENCE_STEPS,
+        "guidance_scale": GUIDANCE_SCALE,
+        "num_images": NUM_IMAGES,
+        "output_format": OUTPUT_FORMAT,
+        "resolution_mode": RESOLUTION_MODE,
+        "enable_safety_checker": ENABLE_SAFETY_CHECKER,
+        "sync_mode": SYNC_MODE,
+        "acceleration": ACCELERATION,
+        "loras": [
+            {
+                "path": LORA_URL,
+                "scale": LORA_WEIGHT
+            }
+        ]
+    }
+    
     @classmethod
-    def get_api_payload(cls, image_b64, prompt=None):
+    def get_api_payload(cls, image_url, prompt=None):
         """Generate API payload with current configuration."""
-        return {
-            "image_url": f"data:image/png;base64,{image_b64}",
-            "prompt": prompt or cls.DEFAULT_PROMPT,
-            "num_inference_steps": cls.NUM_INFERENCE_STEPS,
-            "guidance_scale": cls.GUIDANCE_SCALE,
-            "num_images": cls.NUM_IMAGES,
-            "output_format": cls.OUTPUT_FORMAT,
-            "resolution_mode": cls.RESOLUTION_MODE,
-            "enable_safety_checker": cls.ENABLE_SAFETY_CHECKER,
-            "sync_mode": cls.SYNC_MODE,
-            "acceleration": cls.ACCELERATION,
-            "loras": [
-                {
-                    "path": cls.LORA_URL,
-                    "scale": cls.LORA_WEIGHT
-                }
-            ]
-        }
+        payload = cls._BASE_PAYLOAD.copy()
+        payload["image_url"] = image_url
+        payload["prompt"] = prompt or cls.DEFAULT_PROMPT
+        return payload
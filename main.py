@@ -3,64 +3,205 @@ Kontext-Harmonise: A Gradio application for image harmonization using Kontext Lo
 """
 
 import os
+import re
+import logging
 import json
+import atexit
+import asyncio
 import base64
 import zipfile
 import tempfile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 import uuid
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional, Tuple, Dict, Any, Union
+from typing import IO, List, Optional, Tuple, Dict, Any, Union
 from PIL import Image
 import gradio as gr
 from dotenv import load_dotenv
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pybase64
+except ImportError:
+    pybase64 = None
+
 from config import Config
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+_SUFFIX_SET = frozenset(ext.lower() for ext in Config.SUPPORTED_FORMATS)
+
+# API failures that warrant retrying with a smaller (more compressed) image
+_SIZE_ERROR_STATUS_CODES = frozenset({408, 413, 504})
+_SIZE_ERROR_RE = re.compile(
+    r"payload too large|request entity too large|413|content-length|image too large|size limit"
+    r"|timeout|request timeout|file size|maximum size|too big",
+    re.IGNORECASE
+)
+
+
+def _json_loads(data: bytes) -> Any:
+    """Parse JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: Any, indent: bool = False) -> bytes:
+    """Serialize an object to JSON bytes, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_APPEND_NEWLINE if indent else None)
+    return (json.dumps(obj, indent=2) + "\n" if indent else json.dumps(obj)).encode('utf-8')
+
+
+def _b64encode(data: Union[bytes, memoryview]) -> str:
+    """Base64-encode bytes to a str, using pybase64 when available."""
+    if pybase64 is not None:
+        return pybase64.b64encode_as_string(data)
+    return base64.b64encode(data).decode('utf-8')
+
+
+def _b64decode(data: str) -> bytes:
+    """Decode a base64 str, using pybase64 when available."""
+    if pybase64 is not None:
+        return pybase64.b64decode(data, validate=False)
+    return base64.b64decode(data)
+
+
 class KontextHarmonise:
     def __init__(self):
         self.api_key = os.getenv("FAL_KEY")
         if not self.api_key:
             raise ValueError("FAL_KEY not found in environment variables. Please check your .env file.")
         
+        # Shared HTTP session so connections to fal.ai are kept alive and pooled
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount("https://", adapter)
+        # Storage uploads have a base64 fallback, so fail fast instead of retrying
+        self.storage_session = requests.Session()
+        self.api_headers = {
+            "Authorization": f"Key {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        
         self.output_dir = Path(os.getenv("OUTPUT_DIR", Config.OUTPUT_DIR))
         self.output_dir.mkdir(exist_ok=True)
         
+        # Metadata is a JSON snapshot plus an append-only journal of newer entries
         self.metadata_file = self.output_dir / "metadata.json"
+        self.journal_file = self.output_dir / "metadata.ndjson"
         self.metadata = self._load_metadata()
         
+        # Guards metadata state shared by concurrent batch workers and UI requests
+        self._metadata_lock = threading.RLock()
+        self._journal_pending: List[bytes] = []
+        # Most recent images shown in the gallery, mirrored from metadata["images"]
+        self._recent = deque(self.metadata["images"][-20:], maxlen=20)
+        self._journal_entries = 0
+        self.journal = open(self.journal_file, "ab", buffering=1 << 16)
+        if self.journal_file.stat().st_size > 0:
+            # Fold entries left over from the previous run into the snapshot
+            self._compact()
+        atexit.register(self._compact)
+        
         # Create zip downloads directory
         self.zip_dir = self.output_dir / "zip_downloads"
         self.zip_dir.mkdir(exist_ok=True)
         
     def _load_metadata(self) -> Dict:
-        """Load existing metadata or create new."""
+        """Load the metadata snapshot and replay journaled entries on top of it."""
+        metadata = {"images": [], "next_id": 1, "zip_downloads": []}
         if self.metadata_file.exists():
             try:
-                with open(self.metadata_file, 'r') as f:
-                    return json.load(f)
+                metadata = _json_loads(self.metadata_file.read_bytes())
             except:
-                return {"images": [], "next_id": 1, "zip_downloads": []}
-        return {"images": [], "next_id": 1, "zip_downloads": []}
+                pass
+        
+        if self.journal_file.exists():
+            # Entries already in the snapshot (interrupted compaction) are skipped
+            known = {
+                (section, item["filename"])
+                for section in ("images", "zip_downloads")
+                for item in metadata.get(section, [])
+            }
+            with open(self.journal_file, 'rb') as f:
+                for line in f:
+                    try:
+                        record = _json_loads(line)
+                    except:
+                        continue  # Torn write from a crash
+                    entry = record["entry"]
+                    metadata["next_id"] = max(metadata.get("next_id", 1), record["next_id"])
+                    if (record["section"], entry["filename"]) not in known:
+                        metadata.setdefault(record["section"], []).append(entry)
+        
+        return metadata
+    
+    def _record_metadata(self, section: str, entry: Dict):
+        """Add a metadata entry in memory and queue it for the journal."""
+        with self._metadata_lock:
+            self.metadata.setdefault(section, []).append(entry)
+            record = {"section": section, "next_id": self.metadata["next_id"], "entry": entry}
+            self._journal_pending.append(_json_dumps(record) + b"\n")
     
     def _save_metadata(self):
-        """Save metadata to file."""
-        with open(self.metadata_file, 'w') as f:
-            json.dump(self.metadata, f, indent=2)
+        """Append pending metadata entries to the journal."""
+        with self._metadata_lock:
+            if not self._journal_pending:
+                return
+            self.journal.write(b"".join(self._journal_pending))
+            self.journal.flush()
+            self._journal_entries += len(self._journal_pending)
+            self._journal_pending.clear()
+            
+            if self._journal_entries >= Config.METADATA_COMPACT_INTERVAL:
+                self._compact()
+    
+    def _compact(self):
+        """Atomically rewrite the metadata snapshot and truncate the journal."""
+        with self._metadata_lock:
+            self._save_metadata()
+            
+            with tempfile.NamedTemporaryFile(suffix='.json', dir=self.output_dir, delete=False) as temp_file:
+                temp_file.write(_json_dumps(self.metadata, indent=True))
+                temp_path = temp_file.name
+            Path(temp_path).replace(self.metadata_file)
+            
+            self.journal.truncate(0)
+            self._journal_entries = 0
     
     def _get_next_filename(self) -> str:
         """Generate next sequential filename."""
-        filename = f"{self.metadata['next_id']:05d}.{Config.OUTPUT_FORMAT}"
-        self.metadata['next_id'] += 1
+        with self._metadata_lock:
+            filename = f"{self.metadata['next_id']:05d}.{Config.OUTPUT_FORMAT}"
+            self.metadata['next_id'] += 1
         return filename
     
-    def _compress_image_quality(self, pil_image: Image.Image, quality: int) -> str:
-        """Compress PIL image to base64 with specified quality."""
-        # Convert to RGB if necessary (for JPEG compression)
+    def _to_rgb(self, pil_image: Image.Image) -> Image.Image:
+        """Flatten transparency onto a white background for JPEG compression."""
+        if pil_image.mode == 'RGB':
+            return pil_image
+        if pil_image.mode == 'P' and 'transparency' not in pil_image.info:
+            # Opaque palette image: a single conversion, no compositing needed
+            return pil_image.convert('RGB')
         if pil_image.mode in ('RGBA', 'LA', 'P'):
             # Create white background
             background = Image.new('RGB', pil_image.size, (255, 255, 255))
@@ -68,59 +209,88 @@ class KontextHarmonise:
                 pil_image = pil_image.convert('RGBA')
             background.paste(pil_image, mask=pil_image.split()[-1] if pil_image.mode == 'RGBA' else None)
             pil_image = background
+        return pil_image
+    
+    def _compress_image_quality(self, pil_image: Image.Image, quality: int, buffer: Optional[io.BytesIO] = None) -> io.BytesIO:
+        """Compress PIL image to a JPEG buffer with specified quality, reusing buffer if given."""
+        pil_image = self._to_rgb(pil_image)
         
-        # Compress to JPEG with specified quality
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='JPEG', quality=quality, optimize=True)
-        buffer.seek(0)
+        if buffer is None:
+            buffer = io.BytesIO()
+        else:
+            buffer.seek(0)
+            buffer.truncate()
         
-        return base64.b64encode(buffer.getvalue()).decode('utf-8')
-    
+        # Compress to JPEG with specified quality (no optimize pass: the bytes only go to the API)
+        pil_image.save(buffer, format='JPEG', quality=quality)
+        
+        return buffer
     
-    def _image_to_base64(self, image_input: Union[str, Image.Image]) -> Tuple[str, Image.Image]:
-        """Convert image file or PIL Image to base64, return both base64 and PIL Image."""
-        if isinstance(image_input, str):
-            # Load from file path
-            pil_image = Image.open(image_input)
-        else:
-            # Already a PIL Image
-            pil_image = image_input
+    def _upload_image(self, image_bytes: bytes) -> str:
+        """Upload JPEG bytes to fal storage and return the hosted URL."""
+        response = self.storage_session.post(
+            Config.STORAGE_UPLOAD_ENDPOINT,
+            json={"content_type": "image/jpeg", "file_name": f"{uuid.uuid4().hex}.jpg"},
+            headers=self.api_headers,
+            timeout=10
+        )
+        response.raise_for_status()
+        upload = response.json()
         
-        # Start with high quality (95%)
-        base64_data = self._compress_image_quality(pil_image, 95)
-        return base64_data, pil_image
+        response = self.storage_session.put(
+            upload["upload_url"],
+            data=image_bytes,
+            headers={"Content-Type": "image/jpeg"},
+            timeout=30
+        )
+        response.raise_for_status()
+        return upload["file_url"]
+    
+    def _image_to_url(self, buffer: io.BytesIO) -> str:
+        """Get an image_url for the API: hosted upload, or a base64 data URI if that fails."""
+        if Config.UPLOAD_IMAGES:
+            try:
+                return self._upload_image(buffer.getvalue())
+            except Exception as e:
+                logger.warning("Image upload to fal storage failed, sending base64 instead: %s", e)
+        # Encode from a zero-copy view of the buffer; released before the buffer is reused
+        with buffer.getbuffer() as image_view:
+            return "".join(("data:image/jpeg;base64,", _b64encode(image_view)))
+    
+    
+    def _load_image(self, image_file: Union[str, IO[bytes]]) -> Image.Image:
+        """Load an image from a path or file object fully into memory."""
+        pil_image = Image.open(image_file)
+        pil_image.load()
+        return pil_image
     
     def _is_size_error(self, error: Exception) -> bool:
         """Check if error is related to image size/payload limits."""
-        error_str = str(error).lower()
-        size_indicators = [
-            'payload too large', 'request entity too large', '413', 'content-length',
-            'image too large', 'size limit', 'timeout', 'request timeout', 
-            'file size', 'maximum size', 'too big'
-        ]
-        return any(indicator in error_str for indicator in size_indicators)
+        if isinstance(error, requests.HTTPError) and error.response is not None:
+            if error.response.status_code in _SIZE_ERROR_STATUS_CODES:
+                return True
+        return bool(_SIZE_ERROR_RE.search(str(error)))
     
     def _call_api_with_fallback(self, pil_image: Image.Image, prompt: Optional[str] = None) -> Tuple[Dict[Any, Any], str]:
         """Make API call with intelligent compression fallback."""
-        headers = {
-            "Authorization": f"Key {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        
         quality_levels = [95, 85, 75, 65, 50]  # Progressive compression
         compression_applied = ""
         
+        # Flatten once and share one encode buffer across all quality levels
+        pil_image = self._to_rgb(pil_image)
+        buffer = io.BytesIO()
+        
         for i, quality in enumerate(quality_levels):
             try:
                 # Compress image at current quality level
-                image_b64 = self._compress_image_quality(pil_image, quality)
-                payload = Config.get_api_payload(image_b64, prompt)
+                self._compress_image_quality(pil_image, quality, buffer)
+                payload = Config.get_api_payload(self._image_to_url(buffer), prompt)
                 
                 # Track compression for user notification
                 if i > 0:  # Only notify if compression was applied
                     compression_applied = f"⚠️ Image compressed to {quality}% quality due to size limits"
                 
-                response = requests.post(Config.API_ENDPOINT, json=payload, headers=headers, timeout=120)
+                response = self.session.post(Config.API_ENDPOINT, json=payload, headers=self.api_headers, timeout=120)
                 response.raise_for_status()
                 
                 result = response.json()
@@ -144,17 +314,17 @@ class KontextHarmonise:
         try:
             if image_data.startswith('http'):
                 # URL mode (async) - download from URL
-                response = requests.get(image_data, timeout=30)
+                response = self.session.get(image_data, timeout=30)
                 response.raise_for_status()
                 image_content = response.content
             elif image_data.startswith('data:image'):
                 # Base64 data URL mode (sync) - decode base64
                 # Format: data:image/jpeg;base64,{base64_data}
                 base64_data = image_data.split(',', 1)[1]
-                image_content = base64.b64decode(base64_data)
+                image_content = _b64decode(base64_data)
             else:
                 # Raw base64 mode (sync) - decode directly
-                image_content = base64.b64decode(image_data)
+                image_content = _b64decode(image_data)
             
             # Load as PIL Image from memory
             image_buffer = io.BytesIO(image_content)
@@ -168,8 +338,12 @@ class KontextHarmonise:
         except Exception as e:
             raise Exception(f"Failed to load result image: {str(e)}")
     
-    def _save_image_atomically(self, pil_image: Image.Image, filename: str, original_filename: str, prompt: str, compression_note: str = "") -> str:
-        """Atomically save PIL image to disk with metadata."""
+    def _save_image_atomically(self, pil_image: Image.Image, filename: str, original_filename: str, prompt: str, compression_note: str = "", defer_metadata: bool = False) -> str:
+        """Atomically save PIL image to disk with metadata.
+        
+        With defer_metadata the entry is only recorded in memory; the caller
+        is responsible for calling _save_metadata() afterwards.
+        """
         output_path = self.output_dir / filename
         
         try:
@@ -205,8 +379,11 @@ class KontextHarmonise:
             "compression_note": compression_note
         }
         
-        self.metadata["images"].append(metadata_entry)
-        self._save_metadata()
+        with self._metadata_lock:
+            self._record_metadata("images", metadata_entry)
+            self._recent.append(metadata_entry)
+        if not defer_metadata:
+            self._save_metadata()
         
         return str(output_path)
     
@@ -220,7 +397,7 @@ class KontextHarmonise:
             image_path = image_file if isinstance(image_file, str) else image_file.name
             
             # Load image into memory
-            _, pil_image = self._image_to_base64(image_path)
+            pil_image = self._load_image(image_path)
             
             # Use custom prompt or default
             prompt = custom_prompt.strip() or Config.DEFAULT_PROMPT
@@ -259,6 +436,37 @@ class KontextHarmonise:
             error_msg = f"❌ Error processing image: {str(e)}"
             return None, error_msg, ""
     
+    def _process_batch_item(self, zip_ref: zipfile.ZipFile, zip_lock: threading.Lock, info: zipfile.ZipInfo, prompt: str) -> Optional[str]:
+        """Process one image of a batch, returning the saved path (metadata deferred)."""
+        # Load image into memory directly from the archive; ZipFile is not
+        # thread-safe, so workers take turns (decoding is short next to the API wait)
+        with zip_lock:
+            with zip_ref.open(info) as image_fh:
+                pil_image = self._load_image(image_fh)
+        
+        # Make API call with compression fallback
+        result, compression_note = self._call_api_with_fallback(pil_image, prompt)
+        
+        if not result.get("images"):
+            return None
+        
+        # Convert result to PIL Image
+        result_image_data = result["images"][0]["url"]
+        result_pil_image = self._result_to_pil_image(result_image_data)
+        
+        # Save atomically
+        original_filename = os.path.basename(info.filename)
+        output_filename = self._get_next_filename()
+        
+        return self._save_image_atomically(
+            result_pil_image, 
+            output_filename, 
+            original_filename, 
+            prompt, 
+            compression_note,
+            defer_metadata=True
+        )
+    
     def process_batch_images(self, zip_file, custom_prompt: str = "", progress=gr.Progress()) -> Tuple[str, str]:
         """Process a batch of images from a zip file with progress tracking."""
         if zip_file is None:
@@ -266,66 +474,50 @@ class KontextHarmonise:
         
         try:
             prompt = custom_prompt.strip() or Config.DEFAULT_PROMPT
-            processed_files = []
             
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Handle zip_file as filepath string or file object
-                zip_path = zip_file if isinstance(zip_file, str) else zip_file.name
-                
-                # Extract zip
-                with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                    zip_ref.extractall(temp_dir)
-                
+            # Handle zip_file as filepath string or file object
+            zip_path = zip_file if isinstance(zip_file, str) else zip_file.name
+            
+            # Images are decoded straight from the archive, nothing is extracted to disk
+            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
                 # Find image files
-                image_files = []
-                for root, dirs, files in os.walk(temp_dir):
-                    for file in files:
-                        if any(file.lower().endswith(ext) for ext in Config.SUPPORTED_FORMATS):
-                            image_files.append(os.path.join(root, file))
+                image_files = [
+                    info for info in zip_ref.infolist()
+                    if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in _SUFFIX_SET
+                ]
                 
                 if not image_files:
                     return None, "No supported image files found in zip."
                 
-                if len(image_files) > Config.MAX_BATCH_SIZE:
-                    return None, f"Too many images. Maximum allowed: {Config.MAX_BATCH_SIZE}"
+                max_batch_size = Config.MAX_BATCH_SIZE
+                if len(image_files) > max_batch_size:
+                    return None, f"Too many images. Maximum allowed: {max_batch_size}"
                 
-                # Process each image with bulletproof handling and progress tracking
+                # Process images concurrently; each worker mostly waits on the API
                 total_images = len(image_files)
                 progress(0, desc=f"Starting batch processing of {total_images} images...")
                 
-                for i, image_path in enumerate(image_files):
-                    try:
-                        # Update progress
-                        current_progress = (i / total_images)
-                        progress(current_progress, desc=f"Processing image {i+1}/{total_images}: {os.path.basename(image_path)}")
-                        
-                        # Load image into memory
-                        _, pil_image = self._image_to_base64(image_path)
+                results = [None] * total_images
+                zip_lock = threading.Lock()
+                with ThreadPoolExecutor(max_workers=Config.BATCH_WORKERS) as executor:
+                    futures = {
+                        executor.submit(self._process_batch_item, zip_ref, zip_lock, info, prompt): i
+                        for i, info in enumerate(image_files)
+                    }
+                    for completed, future in enumerate(as_completed(futures), start=1):
+                        i = futures[future]
+                        image_name = os.path.basename(image_files[i].filename)
+                        try:
+                            results[i] = future.result()
+                            progress(completed / total_images, desc=f"Processed image {completed}/{total_images}: {image_name}")
+                        except Exception as e:
+                            progress(completed / total_images, desc=f"Error processing {image_name}: {str(e)}")
                         
-                        # Make API call with compression fallback
-                        result, compression_note = self._call_api_with_fallback(pil_image, prompt)
-                        
-                        if result.get("images"):
-                            # Convert result to PIL Image
-                            result_image_data = result["images"][0]["url"]
-                            result_pil_image = self._result_to_pil_image(result_image_data)
-                            
-                            # Save atomically
-                            original_filename = os.path.basename(image_path)
-                            output_filename = self._get_next_filename()
-                            
-                            output_path = self._save_image_atomically(
-                                result_pil_image, 
-                                output_filename, 
-                                original_filename, 
-                                prompt, 
-                                compression_note
-                            )
-                            processed_files.append(output_path)
-                            
-                    except Exception as e:
-                        progress(i / total_images, desc=f"Error processing {os.path.basename(image_path)}: {str(e)}")
-                        continue
+                        # Journal finished images (and the next_id advance) as they
+                        # land, so a crash mid-batch can't reuse their filenames
+                        self._save_metadata()
+                
+                processed_files = [path for path in results if path]
                 
                 if not processed_files:
                     return None, "No images were successfully processed."
@@ -337,7 +529,8 @@ class KontextHarmonise:
                 zip_filename = f"batch_output_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
                 output_zip_path = self.zip_dir / zip_filename
                 
-                with zipfile.ZipFile(output_zip_path, 'w') as zip_out:
+                # Outputs are already compressed images, so store them without deflate
+                with zipfile.ZipFile(output_zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_out:
                     for file_path in processed_files:
                         zip_out.write(file_path, os.path.basename(file_path))
                 
@@ -351,9 +544,7 @@ class KontextHarmonise:
                     "original_zip": os.path.basename(zip_path)
                 }
                 
-                if "zip_downloads" not in self.metadata:
-                    self.metadata["zip_downloads"] = []
-                self.metadata["zip_downloads"].append(zip_metadata)
+                self._record_metadata("zip_downloads", zip_metadata)
                 self._save_metadata()
                 
                 progress(1.0, desc="Batch processing completed!")
@@ -368,7 +559,10 @@ class KontextHarmonise:
     def _get_gallery_data(self) -> List[Tuple[str, str]]:
         """Get gallery data for display."""
         gallery_items = []
-        for item in reversed(self.metadata["images"][-20:]):  # Show last 20 images
+        with self._metadata_lock:
+            # Snapshot so concurrent batch workers can't mutate the deque mid-iteration
+            recent = list(self._recent)
+        for item in reversed(recent):
             if os.path.exists(item["output_path"]):
                 caption = f"{item['filename']}\n{item['timestamp'][:19]}"
                 if item.get('compression_note'):
@@ -391,10 +585,10 @@ class KontextHarmonise:
     def get_image_metadata(self, evt: gr.SelectData) -> str:
         """Get metadata for selected gallery image."""
         try:
-            # Get the selected image index
-            selected_images = list(reversed(self.metadata["images"][-20:]))
-            if evt.index < len(selected_images):
-                item = selected_images[evt.index]
+            # Gallery index counts back from the newest image
+            recent = self._recent
+            if 0 <= evt.index < len(recent):
+                item = recent[-1 - evt.index]
                 metadata_text = f"""
 **Filename:** {item['filename']}
 **Original:** {item['original_filename']}  
@@ -442,8 +636,9 @@ def create_interface():
                         single_output = gr.Image(label="Harmonized Image", height=400)
                         single_status = gr.Textbox(label="Status", lines=3)
                 
-                def handle_single_image(image_file, custom_prompt):
-                    result_image, status_msg, _ = app.process_single_image(image_file, custom_prompt)
+                async def handle_single_image(image_file, custom_prompt):
+                    # Run the blocking pipeline (PIL work + API wait) in a worker thread
+                    result_image, status_msg, _ = await asyncio.to_thread(app.process_single_image, image_file, custom_prompt)
                     gallery_data = app._get_gallery_data()
                     return result_image, status_msg, gallery_data
                 